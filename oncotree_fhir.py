@@ -2,19 +2,78 @@
 """
 
 import sys
-import json
 import argparse
+import contextlib
+import csv
 import os
 import textwrap
-from csv import DictWriter
-from typing import Dict, List, Tuple
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
+from typing import TYPE_CHECKING, Dict, List, Sequence, Tuple
+import orjson
 import requests
-from fhir.resources.codesystem import (
-    CodeSystem,
-    CodeSystemConcept,
-    CodeSystemConceptProperty,
+from requests.adapters import HTTPAdapter
+
+if TYPE_CHECKING:
+    from fhir.resources.codesystem import CodeSystemConcept
+
+# shared between all requests (and threads), so connections to the API are kept alive and reused
+SESSION = requests.Session()
+# large enough for all the worker threads of convert-all to hold a connection at the same time
+SESSION.mount("http://", HTTPAdapter(pool_connections=16, pool_maxsize=16))
+SESSION.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=16))
+# serializes the output of the versions that are converted concurrently
+PRINT_LOCK = threading.Lock()
+
+# the undated versions of Oncotree, that are converted to the snapshot CodeSystem
+_SNAPSHOT_VERSIONS = frozenset(
+    [
+        "oncotree_latest_stable",
+        "oncotree_candidate_release",
+        "oncotree_development",
+        "oncotree_legacy_1.1",
+    ]
 )
-from tqdm import tqdm
+
+# the parts of the CodeSystem that are the same for every version. The keys set to None are
+# filled in by convert_oncotree, they are listed here so the key order of the output is kept.
+_CS_SKELETON = {
+    "resourceType": "CodeSystem",
+    "id": None,
+    "url": None,
+    "valueSet": None,
+    "status": "draft",
+    "content": "complete",
+    "name": None,
+    "title": None,
+    "version": None,
+    "date": None,
+    "hierarchyMeaning": "is-a",
+    "property": [
+        {
+            "code": "color",
+            "description": "Color in the Oncotree Visualisation",
+            "type": "string",
+        },
+        {
+            "code": "level",
+            "description": "Level in the Oncotree hierarchy",
+            "type": "integer",
+        },
+        {
+            "code": "umls",
+            "description": "Linked UMLS concept",
+            "type": "string",
+        },
+        {
+            "code": "nci",
+            "description": "Linked NCI concept",
+            "type": "string",
+        },
+    ],
+    "concept": None,
+}
 
 
 def parse_args(print_args: bool = True):
@@ -73,6 +132,11 @@ def parse_args(print_args: bool = True):
         default=os.path.join(".", "$version.tsv"),
         help="output file in TSV format (if --write-tsv given). $version is replaced with the version string in filename"
     )
+    parser.add_argument(
+        "--debug",
+        help="write the raw response of the Oncotree API to $version.tmp.json in the working directory",
+        action="store_true"
+    )
     parser.add_argument(
         "action",
         default="convert",
@@ -85,11 +149,10 @@ def parse_args(print_args: bool = True):
     args = parser.parse_args()
 
     if print_args:
-        for arg in vars(args):
-            print(f" - {arg}: {getattr(args, arg)}")
+        print("\n".join(f" - {arg}: {value}" for arg, value in vars(args).items()))
 
     available_versions = get_versions(args)
-    if args.version not in list(x["api_identifier"] for x in available_versions):
+    if args.version not in {x["api_identifier"] for x in available_versions}:
         parser.error(
             f"version '{args.version}' is not known to the endpoint {args.url}. Use the 'versions' operation to list the available versions"
         )
@@ -106,12 +169,15 @@ def parse_args(print_args: bool = True):
 class TreeNode:
     """ a node in the version tree graph """
 
-    def __init__(self, value: str = None, children: 'List[TreeNode]' = None):
+    __slots__ = ("value", "children")
+
+    def __init__(self, value: str = None, children: 'Sequence[TreeNode]' = None):
         """create a tree node, perhaps with children
 
         Args:
             value (str, optional): the text value of the node. Defaults to None.
-            children (List[TreeNode], optional): the children of the node. Defaults to None.
+            children (Sequence[TreeNode], optional): the children of the node. Defaults to None,
+                i.e. a new empty list. Leaf nodes that never get children appended can pass an empty tuple.
         """
         if children is None:
             children = []
@@ -121,32 +187,40 @@ class TreeNode:
 def pprint_tree(node: TreeNode, file=None, _prefix="", _last=True, width=70):
     """Pretty-print a tree of nodes, from https://vallentin.dev/2016/11/29/pretty-print-tree
 
+    The tree is walked depth-first with an explicit stack and all lines are
+    collected first, so the output is written with a single call to print().
+
     Args:
         node ([type]): the root node
         file ([type], optional): File to pass to print(). Defaults to None.
-        _prefix (str, optional): internal for recursive calls. Defaults to "".
-        _last (bool, optional): internal for recursive calls. Defaults to True.
+        _prefix (str, optional): prefix of the root line. Defaults to "".
+        _last (bool, optional): whether the root is drawn as the last child. Defaults to True.
     """
 
-    def wrap_to_width(val: str) -> str:
+    def wrap_to_width(val: str, prefix: str) -> str:
         wrapped_value = textwrap.wrap(val, width=width)
         if len(wrapped_value) > 1:
             join_wrapped_value = "\n".join(wrapped_value[1:])
             return (
                 wrapped_value[0]
                 + "\n"
-                + textwrap.indent(join_wrapped_value, " " * (len(_prefix) + 3))
+                + textwrap.indent(join_wrapped_value, " " * (len(prefix) + 3))
             )
         else:
             return wrapped_value[0]
 
-    filled_value = wrap_to_width(node.value)
-    print(_prefix, "`- " if _last else "|- ", filled_value, sep="", file=file)
-    _prefix += "   " if _last else "|  "
-    child_count = len(node.children)
-    for i, child in enumerate(node.children):
-        _last = i == (child_count - 1)
-        pprint_tree(child, file, _prefix, _last)
+    lines = []
+    stack = [(node, _prefix, _last)]
+    while stack:
+        node, prefix, last = stack.pop()
+        filled_value = wrap_to_width(node.value, prefix)
+        lines.append(prefix + ("`- " if last else "|- ") + filled_value)
+        child_prefix = prefix + ("   " if last else "|  ")
+        child_count = len(node.children)
+        # push in reverse, so that the first child is popped (and printed) first
+        for i in reversed(range(child_count)):
+            stack.append((node.children[i], child_prefix, i == (child_count - 1)))
+    print("\n".join(lines), file=file)
 
 
 def get_versions(args: argparse.Namespace) -> List[Dict]:
@@ -159,12 +233,38 @@ def get_versions(args: argparse.Namespace) -> List[Dict]:
         List[Dict]: the list of versions as a (JSON) dict.
     """
     endpoint = f"{args.url}/versions"
-    rx = requests.get(endpoint).json()
-    rx.sort(key=lambda x: x["release_date"], reverse=True)
+    rx = SESSION.get(endpoint).json()
+    rx.sort(key=itemgetter("release_date"), reverse=True)
     return rx
 
 
-def convert_oncotree(args: argparse.Namespace, version: str = None) -> CodeSystem:
+class TeeReader:
+    """ a file-like object that copies everything read from a stream to a second file """
+
+    def __init__(self, source, sink):
+        """wrap a binary stream
+
+        Args:
+            source ([type]): the binary stream to read from, e.g. the raw HTTP response
+            sink ([type]): the binary file every chunk that is read is also written to
+        """
+        self.source, self.sink = source, sink
+
+    def read(self, size: int = -1) -> bytes:
+        """read up to size bytes from the source and copy them to the sink
+
+        Args:
+            size (int, optional): the maximum number of bytes to read. Defaults to -1, i.e. everything.
+
+        Returns:
+            bytes: the bytes that were read
+        """
+        chunk = self.source.read(size)
+        self.sink.write(chunk)
+        return chunk
+
+
+def convert_oncotree(args: argparse.Namespace, version: str = None) -> Dict:
     """convert the oncotree system with given version to FHIR
 
     Args:
@@ -172,28 +272,23 @@ def convert_oncotree(args: argparse.Namespace, version: str = None) -> CodeSyste
         version (str, optional): the version string Defaults to None. If not specified, args.version is used
 
     Returns:
-        CodeSystem: the code system in FHIR R4 format
+        Dict: the code system in FHIR R4 JSON format
     """
+    # imported here, so that the versions action does not pay for these imports
+    import ijson
+    from tqdm import tqdm
+
     if version is None:
         version = args.version
 
     endpoint = f"{args.url}/tumorTypes?version={version}"
-    rx = requests.get(endpoint)
-    with open(os.path.join(".", "oncotree.tmp.json"), "w") as f:
-        json.dump(rx.json(), f, indent=2)
-
     date_of_version = date_for_version_string(version)
     valueset_url = args.valueset.rstrip("/")
     codesystem_url = args.canonical.rstrip("/")
     name = "oncotree"
     title = "OncoTree"
 
-    if version in [
-        "oncotree_latest_stable",
-        "oncotree_candidate_release",
-        "oncotree_development",
-        "oncotree_legacy_1.1",
-    ]:
+    if version in _SNAPSHOT_VERSIONS:
         fhir_version = version.replace("_", "-")
         codesystem_url += "/" + "snapshot"
         valueset_url += "/" + "snapshot"
@@ -202,58 +297,52 @@ def convert_oncotree(args: argparse.Namespace, version: str = None) -> CodeSyste
     else:
         fhir_version = version.replace("oncotree_", "").replace("_", "")
 
-    print(
-        f"getting {version} (released {date_of_version}) from {endpoint}")
-    print()
-
     json_dict = {
-        "resourceType": "CodeSystem",
+        **_CS_SKELETON,
         "id": version.replace("_", "-"),
         "url": codesystem_url,
         "valueSet": valueset_url,
-        "status": "draft",
-        "content": "complete",
         "name": name,
         "title": title,
         "version": fhir_version,
         "date": date_of_version,
-        "hierarchyMeaning": "is-a",
-        "property": [
-            {
-                "code": "color",
-                "description": "Color in the Oncotree Visualisation",
-                "type": "string",
-            },
-            {
-                "code": "level",
-                "description": "Level in the Oncotree hierarchy",
-                "type": "integer",
-            },
-            {
-                "code": "umls",
-                "description": "Linked UMLS concept",
-                "type": "string",
-            },
-            {
-                "code": "nci",
-                "description": "Linked NCI concept",
-                "type": "string",
-            },
-        ],
+        # copied, so that the returned dict does not share mutable state with the skeleton
+        "property": [dict(p) for p in _CS_SKELETON["property"]],
         "concept": [],
     }
-    print(json.dumps(json_dict))
-    cs = CodeSystem(json_dict)
-    print()
-    print("Converting concepts...")
-    sys.stdout.flush()
-    for concept in tqdm(rx.json()):
-        fhir_concept = convert_concept(concept)
-        cs.concept.append(fhir_concept)
-    return cs
-
-
-def convert_concept(oncotree_concept: Dict) -> CodeSystemConcept:
+    banner = "\n".join(
+        [
+            f"getting {version} (released {date_of_version}) from {endpoint}",
+            "",
+            orjson.dumps(json_dict).decode("utf-8"),
+            "",
+            "Converting concepts...",
+        ]
+    )
+    with PRINT_LOCK:
+        sys.stdout.write(banner + "\n")
+        sys.stdout.flush()
+    # one tmp file per version, as several versions may be converted concurrently
+    tmp_path = os.path.join(".", f"{version}.tmp.json")
+    with SESSION.get(endpoint, stream=True) as rx, \
+            open(tmp_path, "wb") if args.debug else contextlib.nullcontext() as f:
+        rx.raise_for_status()
+        # let urllib3 undo any Content-Encoding, ijson expects the plain JSON bytes
+        rx.raw.decode_content = True
+        # parse the response concept by concept while it is downloaded,
+        # copying the raw bytes to the tmp file on the way if requested
+        source = rx.raw if f is None else TeeReader(rx.raw, f)
+        # the progress bars of concurrently converted versions would overwrite each other
+        progress = tqdm(ijson.items(source, "item"), mininterval=0.5,
+                        disable=args.action == "convert-all")
+        for concept in progress:
+            json_dict["concept"].append(convert_concept_dict(concept))
+    # the payload is trusted and only serialized again, so the dict is returned as-is
+    # instead of running it through the fhir.resources model validation
+    return json_dict
+
+
+def convert_concept(oncotree_concept: Dict) -> "CodeSystemConcept":
     """convert the oncotree concept to a FHIR R4 CodeSystem concept
 
     Args:
@@ -262,75 +351,76 @@ def convert_concept(oncotree_concept: Dict) -> CodeSystemConcept:
     Returns:
         CodeSystemConcept: the element in FHIR R4, with properties
     """
-    concept = CodeSystemConcept(
-        {
-            "code": oncotree_concept["code"],
-            "display": oncotree_concept["name"],
-            "property": [],
-        }
-    )
+    # the fhir.resources models are slow to import and only needed here
+    from fhir.resources.codesystem import CodeSystemConcept
 
-    concept.property.append(
-        CodeSystemConceptProperty(
-            {"code": "level", "valueInteger": oncotree_concept["level"]}
-        )
+    return CodeSystemConcept(convert_concept_dict(oncotree_concept))
+
+
+def convert_concept_dict(oncotree_concept: Dict) -> Dict:
+    """convert the oncotree concept to the JSON representation of a FHIR R4 CodeSystem concept
+
+    Args:
+        oncotree_concept (Dict): the element from the Oncotree API to convert
+
+    Returns:
+        Dict: the element in FHIR R4 JSON format, with properties
+    """
+    concept = {
+        "code": oncotree_concept["code"],
+        "display": oncotree_concept["name"],
+        "property": [],
+    }
+
+    concept["property"].append(
+        {"code": "level", "valueInteger": oncotree_concept["level"]}
     )
 
-    if "color" in oncotree_concept and oncotree_concept["color"] is not None:
-        concept.property.append(
-            CodeSystemConceptProperty(
-                {"code": "color", "valueString": oncotree_concept["color"]}
-            )
-        )
+    color = oncotree_concept.get("color")
+    if color is not None:
+        concept["property"].append({"code": "color", "valueString": color})
 
-    if "parent" in oncotree_concept and oncotree_concept["parent"] is not None:
-        concept.property.append(
-            CodeSystemConceptProperty(
-                {"code": "parent", "valueCode": oncotree_concept["parent"]}
-            )
-        )
+    parent = oncotree_concept.get("parent")
+    if parent is not None:
+        concept["property"].append({"code": "parent", "valueCode": parent})
 
-    if len(oncotree_concept["externalReferences"]) > 0:
-        if "UMLS" in oncotree_concept["externalReferences"]:
-            concept.property.append(
-                CodeSystemConceptProperty(
-                    {
-                        "code": "umls",
-                        "valueString": ", ".join(
-                            oncotree_concept["externalReferences"]["UMLS"]
-                        ),
-                        # there is at least on concept, SRCCR, that has multiple UMLS and NCI references
-                    }
-                )
-            )
-        if "NCI" in oncotree_concept["externalReferences"]:
-            concept.property.append(
-                CodeSystemConceptProperty(
-                    {
-                        "code": "nci",
-                        "valueString": ", ".join(
-                            oncotree_concept["externalReferences"]["NCI"]
-                        ),
-                    }
-                )
-            )
+    external_references = oncotree_concept.get("externalReferences") or {}
+    umls = external_references.get("UMLS")
+    if umls is not None:
+        concept["property"].append(
+            {
+                "code": "umls",
+                "valueString": ", ".join(umls),
+                # there is at least on concept, SRCCR, that has multiple UMLS and NCI references
+            }
+        )
+    nci = external_references.get("NCI")
+    if nci is not None:
+        concept["property"].append(
+            {
+                "code": "nci",
+                "valueString": ", ".join(nci),
+            }
+        )
     return concept
 
 
-def write_codesystem(args: argparse.Namespace, cs: CodeSystem, version: str = None):
+def write_codesystem(args: argparse.Namespace, cs: Dict, version: str = None):
     """write the codesystem to a JSON file, as defined by the args
 
     Args:
         args (argparse.Namespace): the command line args
-        cs (CodeSystem): the FHIR code system to write
+        cs (Dict): the FHIR code system to write, in JSON format
         version (str): the version string. Default to None. If not specified, args.version is used.
     """
     if version is None:
         version = args.version
     _, filepath = sanitize_filename(args.output, version)
-    with open(filepath, "w") as jf:
-        json.dump(cs.as_json(), jf, indent=2)
-    print(f"Wrote output to {filepath}")
+    payload = orjson.dumps(cs, option=orjson.OPT_INDENT_2)
+    with open(filepath, "wb", buffering=1 << 20) as jf:
+        jf.write(payload)
+    with PRINT_LOCK:
+        sys.stdout.write(f"Wrote output to {filepath}\n")
 
 
 def sanitize_filename(fn: str, version: str) -> Tuple[str, str]:
@@ -361,9 +451,7 @@ def date_for_version_string(version_string: str) -> str:
     Returns:
         str: the release date of the version string, in ISO 8601 format, i.e. "YYYY-MM-DD"
     """
-    return [v for v in versions if v["api_identifier"] == version_string][0][
-        "release_date"
-    ]
+    return version_index[version_string]["release_date"]
 
 
 def print_versions(versions: List[str]):
@@ -391,10 +479,10 @@ def print_versions(versions: List[str]):
         for version in versions:
             node = TreeNode(
                 version["api_identifier"],
-                [
-                    TreeNode(f"released {version['release_date']}"),
-                    TreeNode(version["description"]),
-                ],
+                (
+                    TreeNode(f"released {version['release_date']}", ()),
+                    TreeNode(version["description"], ()),
+                ),
             )
             root.children.append(node)
         return root
@@ -408,12 +496,12 @@ def print_versions(versions: List[str]):
     pprint_tree(root_node)
 
 
-def write_tsv_codesystem(args: argparse.Namespace, cs: CodeSystem, version: str) -> None:
+def write_tsv_codesystem(args: argparse.Namespace, cs: Dict, version: str) -> None:
     """write the codesystem to a JSON file, as defined by the args (or return immediately if no TSV files should be written)
 
     Args:
         args (argparse.Namespace): the command line args
-        cs (CodeSystem): the FHIR CS to write
+        cs (Dict): the FHIR CS to write, in JSON format
         version (str): the version string of this file
 
     Returns:
@@ -421,37 +509,48 @@ def write_tsv_codesystem(args: argparse.Namespace, cs: CodeSystem, version: str)
     """
     if not args.write_tsv:
         return None
-    fieldnames = ["code", "label", "parent"]
-
-    def parent_for_code(c: str) -> str:
-        """helper function to return the parent of a FHIR code system concept
-
-        Args:
-            c (str): the concept to extract the property for
-
-        Returns:
-            str: the code of the parent, or None
-        """
-        p = [p for p in c.property if p.code == "parent"]
-        if any(p):
-            return p[0].valueCode
-        return None
+    fieldnames = ("code", "label", "parent")
 
-    tsv_codes = [{"code": c.code, "label": c.display,
-                  "parent": parent_for_code(c)} for c in cs.concept]
-    tsv_codes.sort(key=lambda c: c["code"])
+    # map every code to the code of its parent (or None) in a single pass over the concepts
+    parents = {
+        c["code"]: next(
+            (p["valueCode"] for p in c["property"] if p["code"] == "parent"), None
+        )
+        for c in cs["concept"]
+    }
+    tsv_rows = [(c["code"], c["display"], parents[c["code"]])
+                for c in cs["concept"]]
+    tsv_rows.sort(key=itemgetter(0))
     #tsv_filename = args.tsv_output.replace("$version", version)
     tsv_filename, tsv_path = sanitize_filename(args.tsv_output, version)
     with open(tsv_path, "w") as csvfile:
-        writer = DictWriter(csvfile, fieldnames=fieldnames, delimiter="\t")
-        writer.writerows(tsv_codes)
-    print(f"wrote TSV to {tsv_filename}")
+        writer = csv.writer(csvfile, delimiter="\t")
+        writer.writerow(fieldnames)
+        writer.writerows(tsv_rows)
+    with PRINT_LOCK:
+        sys.stdout.write(f"wrote TSV to {tsv_filename}\n")
+
+
+def convert_and_write(args: argparse.Namespace, version: str) -> None:
+    """convert a single version of Oncotree and write it to the JSON (and TSV, if requested) output files
+
+    Args:
+        args (argparse.Namespace): the command line args
+        version (str): the version string to convert
+    """
+    cs = convert_oncotree(args, version)
+    write_codesystem(args, cs, version)
+    write_tsv_codesystem(args, cs, version)
+    with PRINT_LOCK:
+        sys.stdout.write(f"Converted version {version}\n\n----\n\n")
+        sys.stdout.flush()
 
 
 if __name__ == "__main__":
     args = parse_args()
     print("\n")
     versions = get_versions(args)
+    version_index = {v["api_identifier"]: v for v in versions}
     if args.action == "versions":
         print_versions(versions)
     elif args.action == "convert":
@@ -459,11 +558,12 @@ if __name__ == "__main__":
         write_codesystem(args, cs)
         write_tsv_codesystem(args, cs, args.version)
     elif args.action == "convert-all":
-        for v in versions:
-            version = v["api_identifier"]
-            print(f"Getting version {version}")
-            cs = convert_oncotree(args, version)
-            write_codesystem(args, cs, version)
-            write_tsv_codesystem(args, cs, version)
-            print("\n----\n")
-            sys.stdout.flush()
+        # the conversion is dominated by waiting on the API, so threads are sufficient here
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            futures = [
+                executor.submit(convert_and_write, args, v["api_identifier"])
+                for v in versions
+            ]
+            for future in futures:
+                # re-raise any exception from the worker threads
+                future.result()